@@ -1,5 +1,10 @@
+import io
 import json 
-from typing import List, Dict, Any, Optional, Tuple 
+import re
+import time
+import asyncio
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable, Iterator, Union
 
 from astrbot.api import logger, AstrBotConfig 
 from astrbot.api.event import filter, AstrMessageEvent 
@@ -12,104 +17,546 @@ try:
     from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import AiocqhttpMessageEvent 
     IS_AIOCQHTTP = True 
 except ImportError: 
+    AiocqhttpMessageEvent = None 
     IS_AIOCQHTTP = False 
 
+# 平台事件类型，非 aiocqhttp 环境下为 None；钩子中只需一次判断即可短路
+_AIOCQ_TYPE = AiocqhttpMessageEvent if IS_AIOCQHTTP else None
+
+# 优先使用 orjson 解析 JSON，未安装时回退到标准库。
+# 两者的解析错误都是 ValueError 的子类，捕获时统一使用 ValueError。
+try: 
+    import orjson 
+except ImportError: 
+    orjson = None 
+_loads = orjson.loads if orjson else json.loads 
+
+# API 响应缓存的默认容量与有效期（秒），可通过配置项覆盖
+_CACHE_MAXSIZE = 256
+_CACHE_TTL = 300
+_MISSING = object()
+# 节点数超过该值时，将结构解析放到线程池中执行，避免阻塞事件循环
+_EXECUTOR_PARSE_THRESHOLD = 50
+# 通过 ID 引用的嵌套转发，最多继续向下拉取的层数
+_MAX_NESTED_FETCH_DEPTH = 3
+# 注入 LLM 的聊天记录字符上限，超出部分不再解析、不再写入提示词
+_MAX_CHAT_RECORD_CHARS = 120_000
+
+# 用户未提问时使用的默认问题
+_DEFAULT_QUERY = "请总结一下这个聊天记录"
+# 提示词模板，依次填入 (用户问题, 聊天记录)；聊天记录每行均以换行结尾
+_CHAT_RECORDS_BLOCK = "聊天记录如下：\n--- 聊天记录开始 ---\n%s--- 聊天记录结束 ---"
+_WAKE_PROMPT_TEMPLATE = "%s\n\n用户是在吐槽以下聊天记录中的内容，请根据以下聊天记录内容来响应用户的吐槽。" + _CHAT_RECORDS_BLOCK
+_AUTO_PROMPT_TEMPLATE = "这是用户的问题：'%s'\n\n请根据以下聊天记录内容来回答用户的问题。" + _CHAT_RECORDS_BLOCK
+
+# OneBot 对卡片消息数据做的 CQ 码转义，只还原这几种；其他实体（如 "&#34;"）原样保留，否则会破坏 JSON 字符串
+_CQ_UNESCAPES = {"&#44;": ",", "&#91;": "[", "&#93;": "]", "&amp;": "&"}
+_CQ_ESCAPE_RE = re.compile("|".join(map(re.escape, _CQ_UNESCAPES)))
+# 图片在文本中的占位符
+_IMG_TAG = "[图片]"
+
+
+def _unescape_cq(match: "re.Match[str]") -> str:
+    return _CQ_UNESCAPES[match.group(0)]
+
+
+def _loads_card_json(data: str) -> Any:
+    """一次性还原 CQ 码转义后解析卡片 JSON。"""
+    if "&" in data:
+        data = _CQ_ESCAPE_RE.sub(_unescape_cq, data)
+    return _loads(data)
+
+
+def _parse_text_segment(seg_data: Dict[str, Any], node_text_parts: list[str], image_urls: list[str], seen_urls: set, nested: list):
+    text = seg_data.get("text", "") 
+    if text: 
+        node_text_parts.append(text) 
+
+
+def _parse_image_segment(seg_data: Dict[str, Any], node_text_parts: list[str], image_urls: list[str], seen_urls: set, nested: list):
+    url = seg_data.get("url") 
+    if url: 
+        # 重复的图片（表情包等）只发送一次，但保留文本中的 [图片] 占位
+        if url not in seen_urls:
+            seen_urls.add(url)
+            image_urls.append(url) 
+        node_text_parts.append(_IMG_TAG) 
+
+
+def _parse_forward_segment(seg_data: Dict[str, Any], node_text_parts: list[str], image_urls: list[str], seen_urls: set, nested: list):
+    # 内嵌内容 (list) 或仅有的 forward_id (str) 交由解析器展开 / 拉取
+    nested_content = seg_data.get("content")
+    if isinstance(nested_content, list):
+        nested.append(nested_content)
+    elif seg_data.get("id"):
+        nested.append(str(seg_data["id"]))
+    else:
+        node_text_parts.append("[转发消息内容缺失或格式错误]")
+
+
+# 消息段类型 -> 解析函数
+_SEGMENT_PARSERS: Dict[str, Callable[[Dict[str, Any], list[str], list[str], set, list], None]] = {
+    "text": _parse_text_segment,
+    "image": _parse_image_segment,
+    "forward": _parse_forward_segment,
+}
+
+
+class _Uncached:
+    """包装不应写入缓存的填充结果（如部分失败的解析结果）：调用方照常拿到 value，下次请求会重新填充。"""
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+class _TTLCache:
+    """
+    简易的 TTL + LRU 缓存，用于缓存 onebot API 的响应。
+    同一 key 的并发填充会共享同一个进行中的 Future，只发起一次 API 调用。
+    """
+    def __init__(self, maxsize: int = _CACHE_MAXSIZE, ttl: float = _CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_fill(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """命中缓存直接返回；否则调用 factory 填充。factory 抛出的异常及返回的 _Uncached 结果不会被缓存。"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        # 填充在所有调用方共享的任务中进行：已有相同 key 的请求在进行中时直接等待其结果，
+        # 任一调用方被取消也不会连带取消其他等待者
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish_fill(key, t))
+        value = await asyncio.shield(task)
+        return value.value if type(value) is _Uncached else value
+
+    def _finish_fill(self, key: str, task: "asyncio.Future[Any]"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 调用 exception() 同时标记异常已被获取，避免无人等待时的 "exception was never retrieved" 警告
+        if not task.cancelled() and task.exception() is None:
+            value = task.result()
+            if type(value) is not _Uncached:
+                self.set(key, value)
+
 
 @register("forward_reader", "EraAsh", "一个使用 LLM 分析合并转发消息内容的插件", "1.2.2", "https://github.com/EraAsh/astrbot_plugin_forward_reader") 
 class ForwardReader(Star): 
+    # 消息链扫描时按 type() 直接查表，避免逐个 isinstance 判断
+    _SEG_DISPATCH = {Comp.Forward: "forward", Comp.Reply: "reply"}
+
     def __init__(self, context: Context, config: AstrBotConfig): 
         super().__init__(context) 
         self.config = config
         self.enable_direct_analysis = self.config.get("enable_direct_analysis", False) 
         self.enable_reply_analysis = self.config.get("enable_reply_analysis", False) 
+        cache_ttl = self.config.get("cache_ttl", _CACHE_TTL)
+        cache_size = self.config.get("cache_size", _CACHE_MAXSIZE)
+        # forward_id -> (chat_records, record_count, image_urls)；image_urls 以元组缓存，防止调用方修改缓存条目
+        self._forward_cache = _TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # reply_id -> (forward_id, json_records)
+        self._reply_cache = _TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # 卡片 JSON 原文 -> json_records
+        self._card_cache = _TTLCache(maxsize=cache_size, ttl=cache_ttl)
     
-    async def _extract_content_recursively(self, message_nodes: List[Dict[str, Any]], extracted_texts: list[str], image_urls: list[str], depth: int = 0):
+    def _extract_content_iterative(self, message_nodes: List[Dict[str, Any]], buf: io.StringIO, image_urls: list[str], seen_urls: set, nested_forwards: List[Tuple[int, int, str]], base_depth: int = 0, budget: int = _MAX_CHAT_RECORD_CHARS) -> int:
         """
-        核心递归解析器。遍历消息节点列表，提取文本、图片，并处理嵌套的 forward 结构。
-        该函数不执行 API 调用，只进行结构解析。
+        核心解析器。以显式栈遍历消息节点列表，提取文本、图片，并展开嵌套的 forward 结构。
+        该函数不执行 API 调用，只进行结构解析；仅带 ID 的嵌套转发会以
+        (插入位置, 层级, forward_id) 的形式记录到 nested_forwards，由调用方拉取。
+        每条记录以 "缩进 发送者: 内容\n" 的形式直接写入 buf，返回写入的记录条数；
+        buf 达到字符预算 budget 后立即停止遍历。base_depth 为顶层节点的缩进层级。
         """
-        indent = "  " * depth
+        record_count = 0
+        indent_cache = [""]
+        # 栈中保存 (节点迭代器, 层级)；嵌套转发压栈后会先于后续的兄弟节点处理
+        stack = [(iter(message_nodes), base_depth)]
+        # 热循环中频繁调用的方法预先绑定为局部变量，省去每次的属性查找
+        write = buf.write
+        tell = buf.tell
+        push = stack.append
+        queue_nested = nested_forwards.append
+        get_parser = _SEGMENT_PARSERS.get
         
-        for message_node in message_nodes: 
+        while stack and tell() < budget: 
+            nodes, depth = stack[-1]
+            message_node = next(nodes, _MISSING)
+            if message_node is _MISSING:
+                stack.pop()
+                continue
+
+            while len(indent_cache) <= depth:
+                indent_cache.append(indent_cache[-1] + "  ")
+
             sender_name = message_node.get("sender", {}).get("nickname", "未知用户") 
+            if type(sender_name) is not str:
+                # buf.write 只接受 str，非字符串昵称（如 null）按原 f-string 的方式渲染
+                sender_name = str(sender_name)
             raw_content = message_node.get("message") or message_node.get("content", []) 
 
             # 解析消息内容链 (兼容字符串和列表格式)
             content_chain = [] 
             if isinstance(raw_content, str): 
-                try: 
-                    parsed_content = json.loads(raw_content) 
-                    if isinstance(parsed_content, list): 
-                        content_chain = parsed_content 
-                except (json.JSONDecodeError, TypeError): 
-                    # 无法解析为JSON的字符串内容，当作纯文本处理
+                # 只有以 "[" 开头的字符串才可能是消息段数组，其余直接当作纯文本，免去解析与异常开销
+                if raw_content.lstrip()[:1] == "[":
+                    try: 
+                        parsed_content = _loads(raw_content) 
+                        if isinstance(parsed_content, list): 
+                            content_chain = parsed_content 
+                    except (ValueError, TypeError): 
+                        # 无法解析为JSON的字符串内容，当作纯文本处理
+                        content_chain = [{"type": "text", "data": {"text": raw_content}}] 
+                else:
                     content_chain = [{"type": "text", "data": {"text": raw_content}}] 
             elif isinstance(raw_content, list): 
                 content_chain = raw_content 
 
-            node_text_parts = [] 
-            has_only_forward = False
-            
-            # 遍历消息段，处理文本、图片和嵌套转发
-            if isinstance(content_chain, list):
+            # 单段节点（绝大多数节点的形状）按段类型直接处理，不进入通用的逐段查表循环
+            seg0 = content_chain[0] if len(content_chain) == 1 else None
+            seg_type = seg0.get("type") if type(seg0) is dict else None
+
+            nested = []
+            if seg_type == "forward":
+                # 纯粹的转发消息容器：直接展开嵌套内容，跳过本节点的格式化
+                seg_data = seg0.get("data", {})
+                nested_content = seg_data.get("content")
+                if isinstance(nested_content, list):
+                    push((iter(nested_content), depth + 1))
+                elif seg_data.get("id"):
+                    queue_nested((tell(), depth + 1, str(seg_data["id"])))
+                continue
+            elif seg_type == "text":
+                # 单段文本：直接取文本，不构建中间列表
+                full_node_text = (seg0.get("data", {}).get("text") or "").strip()
+            elif seg_type == "image":
+                # 单段图片：直接登记 URL，节点文本即为占位符
+                url = seg0.get("data", {}).get("url")
+                full_node_text = ""
+                if url:
+                    if url not in seen_urls:
+                        seen_urls.add(url)
+                        image_urls.append(url)
+                    full_node_text = _IMG_TAG
+            else:
+                node_text_parts = [] 
                 
-                # 检查是否为纯粹的转发消息容器
-                if len(content_chain) == 1 and content_chain[0].get("type") == "forward":
-                    has_only_forward = True
-                    
+                # 遍历消息段，按类型查表处理文本、图片和嵌套转发
                 for segment in content_chain: 
-                    if isinstance(segment, dict): 
-                        seg_type = segment.get("type") 
-                        seg_data = segment.get("data", {}) 
-                        
-                        if seg_type == "text": 
-                            text = seg_data.get("text", "") 
-                            if text: 
-                                node_text_parts.append(text) 
-                        elif seg_type == "image": 
-                            url = seg_data.get("url") 
-                            if url: 
-                                image_urls.append(url) 
-                                node_text_parts.append("[图片]") 
-                        
-                        elif seg_type == "forward":
-                            nested_content = seg_data.get("content")
-                            if isinstance(nested_content, list):
-                                await self._extract_content_recursively(nested_content, extracted_texts, image_urls, depth + 1)
-                                
-                            else:
-                                node_text_parts.append("[转发消息内容缺失或格式错误]")
+                    if type(segment) is dict: 
+                        parse_segment = get_parser(segment.get("type"))
+                        if parse_segment is not None:
+                            parse_segment(segment.get("data", {}), node_text_parts, image_urls, seen_urls, nested)
 
+                # 格式化当前消息节点的内容
+                full_node_text = "".join(node_text_parts).strip()
             
-            # 格式化当前消息节点的内容
-            full_node_text = "".join(node_text_parts).strip()
-            
-            if full_node_text and not has_only_forward: 
-                extracted_texts.append(f"{indent}{sender_name}: {full_node_text}")
+            if full_node_text: 
+                write(indent_cache[depth])
+                write(sender_name)
+                write(": ")
+                write(full_node_text)
+                write("\n")
+                record_count += 1
+
+            # 嵌套内容紧跟在当前节点之后输出
+            for nested_item in nested:
+                if type(nested_item) is str:
+                    queue_nested((tell(), depth + 1, nested_item))
+            for nested_item in reversed(nested):
+                if type(nested_item) is list:
+                    push((iter(nested_item), depth + 1))
+
+        return record_count
     
-    async def _extract_forward_content(self, event: AiocqhttpMessageEvent, forward_id: str) -> Tuple[list[str], list[str]]:
+    async def _resolve_reply(self, event: AiocqhttpMessageEvent, reply_seg: Comp.Reply) -> Tuple[Optional[str], str]:
         """
-        从合并转发消息中提取内容，并启动递归解析。
+        解析被回复的消息，返回 (forward_id, json_records)，结果按 reply_id 缓存。
+        两个钩子共用该方法，同一条被回复消息被反复询问时只查询一次。
+        """
+        try: 
+            return await self._reply_cache.get_or_fill(
+                str(reply_seg.id),
+                lambda: self._fetch_reply(event, reply_seg),
+            )
+        except Exception as e: 
+            logger.warning(f"获取被回复消息详情失败: {e}") 
+            return None, ""
+
+    async def _fetch_reply(self, event: AiocqhttpMessageEvent, reply_seg: Comp.Reply) -> Tuple[Optional[str], str]:
+        """
+        优先使用 Reply 附带的消息链，找不到转发内容时才调用 get_msg API。
+        """
+        forward_id, json_records = self._parse_reply_components(reply_seg)
+        if forward_id or json_records:
+            return forward_id, json_records
+
+        original_msg = await event.bot.api.call_action('get_msg', message_id=reply_seg.id)
+        return self._parse_reply_message(original_msg)
+
+    async def _extract_forward_content(self, event: AiocqhttpMessageEvent, forward_id: str) -> Tuple[str, int, Tuple[str, ...]]:
+        """
+        从合并转发消息中提取内容，返回 (chat_records, record_count, image_urls)，结果按 forward_id 缓存（不完整的结果不缓存）。
         """
-        client = event.bot 
-        extracted_texts = [] 
-        image_urls = []
-        
         try: 
-            # 1. 调用 API 获取转发消息详情
-            forward_data = await client.api.call_action('get_forward_msg', id=forward_id) 
+            return await self._forward_cache.get_or_fill(
+                str(forward_id),
+                lambda: self._fetch_forward_content(event, forward_id),
+            )
         except Exception as e: 
             logger.warning(f"调用 get_forward_msg API 失败 (ID: {forward_id}): {e}") 
-            return [], [] 
+            return "", 0, () 
+
+    async def _fetch_forward_content(self, event: AiocqhttpMessageEvent, forward_id: str) -> Union[Tuple[str, int, Tuple[str, ...]], _Uncached]:
+        """
+        调用 get_forward_msg API 获取转发消息详情，并启动结构解析。
+        响应为空或嵌套转发拉取失败时结果不完整，以 _Uncached 包装，避免一次临时错误在整个 TTL 内生效。
+        """
+        forward_data = await event.bot.api.call_action('get_forward_msg', id=forward_id) 
+        chat_records, record_count, image_urls, complete = await self._parse_forward_data(event, forward_id, forward_data)
+        result = (chat_records, record_count, image_urls)
+        return result if complete else _Uncached(result)
+
+    async def _parse_forward_data(self, event: AiocqhttpMessageEvent, forward_id: str, forward_data: Optional[Dict[str, Any]], fetch_depth: int = 0, base_depth: int = 0, budget: int = _MAX_CHAT_RECORD_CHARS) -> Tuple[str, int, Tuple[str, ...], bool]:
+        """
+        解析 get_forward_msg 的响应，并拉取、插回仅以 ID 引用的嵌套转发。
+        返回 (chat_records, record_count, image_urls, complete)，响应为空或任一嵌套转发拉取失败时 complete 为 False。
+        base_depth 为顶层节点的缩进层级，嵌套转发直接按所在层级缩进，与内嵌转发的格式保持一致；
+        budget 为剩余的字符预算，嵌套转发只分到其插入位置之后剩余的预算。
+        """
+        buf = io.StringIO()
+        image_urls = []
+        seen_urls = set()
+        nested_forwards: List[Tuple[int, int, str]] = []
 
         if not forward_data or "messages" not in forward_data: 
             logger.debug(f"获取到的合并转发内容为空或结构异常 (ID: {forward_id})")
-            return [], [] 
+            return "", 0, (), False
+
+        # 1. 启动结构解析，处理所有内嵌层级；节点较多时放到线程池中执行
+        messages = forward_data["messages"]
+        if len(messages) > _EXECUTOR_PARSE_THRESHOLD:
+            record_count = await asyncio.get_running_loop().run_in_executor(
+                None, self._extract_content_iterative, messages, buf, image_urls, seen_urls, nested_forwards, base_depth, budget
+            )
+        else:
+            record_count = self._extract_content_iterative(messages, buf, image_urls, seen_urls, nested_forwards, base_depth, budget)
+
+        if buf.tell() >= budget:
+            logger.debug(f"合并转发内容超出字符预算，已截断 (ID: {forward_id})")
 
-        # 2. 启动递归解析，处理所有内嵌层级
-        await self._extract_content_recursively(forward_data["messages"], extracted_texts, image_urls, depth=0)
+        # 解析完成后原始响应已无用，在等待嵌套转发前释放，避免多层响应同时驻留内存
+        del forward_data, messages
+        chat_records = buf.getvalue()
+        complete = True
+
+        # 2. 拉取仅以 ID 引用的嵌套转发，并按原位置插回；
+        # 按文档顺序计算预算，只跳过插入位置已超出字符预算的嵌套转发
+        if fetch_depth < _MAX_NESTED_FETCH_DEPTH:
+            nested_forwards = [entry for entry in nested_forwards if entry[0] < budget]
+        else:
+            nested_forwards = []
+        if nested_forwards:
+            # API 调用并发进行，同一嵌套转发被多次引用时只拉取一次
+            nested_ids = list(dict.fromkeys(nested_id for _, _, nested_id in nested_forwards))
+            responses = await asyncio.gather(
+                *[event.bot.api.call_action('get_forward_msg', id=nested_id) for nested_id in nested_ids],
+                return_exceptions=True,
+            )
+            responses_by_id = dict(zip(nested_ids, responses))
+            del responses
+            # 解析按文档顺序进行，每个嵌套转发只使用前面内容用剩的预算
+            parts = []
+            start = 0
+            length = 0
+            for position, depth, nested_id in nested_forwards:
+                parts.append(chat_records[start:position])
+                length += position - start
+                start = position
+                remaining = budget - length
+                if remaining <= 0:
+                    continue
+                response = responses_by_id[nested_id]
+                if isinstance(response, Exception):
+                    logger.warning(f"调用 get_forward_msg API 失败 (ID: {nested_id}): {response}")
+                    complete = False
+                    continue
+                nested_records, nested_count, nested_urls, nested_complete = await self._parse_forward_data(
+                    event, nested_id, response, fetch_depth + 1, depth, remaining
+                )
+                complete = complete and nested_complete
+                parts.append(nested_records)
+                length += len(nested_records)
+                record_count += nested_count
+                for url in nested_urls:
+                    if url not in seen_urls:
+                        seen_urls.add(url)
+                        image_urls.append(url)
+            parts.append(chat_records[start:])
+            chat_records = "".join(parts)
         
-        return extracted_texts, image_urls 
+        return chat_records, record_count, tuple(image_urls), complete
+
+    async def _collect_content(self, event: AiocqhttpMessageEvent, forward_id: Optional[str], reply_seg: Optional[Comp.Reply]) -> Tuple[bool, str, int, Tuple[str, ...]]:
+        """
+        获取直接转发与被回复消息中的聊天记录，返回 (是否找到转发内容, chat_records, record_count, image_urls)。
+        两者互不依赖，并发执行以重叠两次 API 往返；优先使用直接转发，提取不到内容时回退到被回复的消息。
+        """
+        tasks = []
+        if forward_id:
+            tasks.append(self._extract_forward_content(event, forward_id))
+        if reply_seg:
+            tasks.append(self._resolve_reply(event, reply_seg))
+        results = await asyncio.gather(*tasks)
+
+        found_content = bool(forward_id)
+        chat_records, record_count, image_urls = "", 0, ()
+        if forward_id:
+            chat_records, record_count, image_urls = results[0]
+
+        if not chat_records and not image_urls and reply_seg:
+            reply_forward_id, json_records = results[-1]
+            if reply_forward_id:
+                found_content = True
+                chat_records, record_count, image_urls = await self._extract_forward_content(event, reply_forward_id) 
+            elif json_records:
+                found_content = True
+                chat_records = json_records
+                record_count = json_records.count("\n")
+
+        return found_content, chat_records, record_count, image_urls
+
+    def _parse_reply_message(self, original_msg: Optional[Dict[str, Any]]) -> Tuple[Optional[str], str]:
+        """
+        解析 get_msg 返回的被回复消息，返回 (forward_id, json_records)。
+        """
+        forward_id: Optional[str] = None
+        json_records = ""
+
+        if not original_msg or 'message' not in original_msg: 
+            return None, ""
+
+        original_message_chain = original_msg['message'] 
+        if not isinstance(original_message_chain, list): 
+            return None, ""
+
+        for segment in original_message_chain: 
+            seg_type = segment.get("type")
+
+            if seg_type == "forward": 
+                forward_id = segment.get("data", {}).get("id") 
+                if forward_id: break
+            
+            elif seg_type == "json":
+                try:
+                    inner_data_str = segment.get("data", {}).get("data")
+                    if inner_data_str:
+                        json_records = self._parse_card_records(inner_data_str)
+                        if json_records: break
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.debug(f"解析 JSON 消息内容失败: {e}")
+                    continue
+
+        return forward_id, json_records
+
+    def _parse_reply_components(self, reply_seg: Comp.Reply) -> Tuple[Optional[str], str]:
+        """
+        部分适配器会在 Reply 消息段上附带被回复消息的消息链 (chain)。
+        优先从中查找转发内容，找到时即可省去一次 get_msg 调用。
+        """
+        chain = getattr(reply_seg, "chain", None)
+        if not chain:
+            return None, ""
+
+        for comp in chain:
+            if isinstance(comp, Comp.Forward):
+                if comp.id:
+                    return comp.id, ""
+            elif isinstance(comp, Comp.Json):
+                inner_json = comp.data
+                try:
+                    if isinstance(inner_json, str):
+                        json_records = self._parse_card_records(inner_json)
+                    elif isinstance(inner_json, dict):
+                        json_records = "".join(f"{text}\n" for text in self._iter_multimsg_texts(inner_json))
+                    else:
+                        continue
+                    if json_records:
+                        return None, json_records
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.debug(f"解析 JSON 消息内容失败: {e}")
+
+        return None, ""
+
+    def _parse_card_records(self, card_data: str) -> str:
+        """
+        解析卡片 JSON 原文并拼接其中的预览文本，结果按原文缓存。
+        同一张合并转发卡片被多条消息回复时原文完全相同，命中后可省去实体还原与 JSON 解析。
+        """
+        json_records = self._card_cache.get(card_data)
+        if json_records is None:
+            inner_json = _loads_card_json(card_data)
+            json_records = "".join(f"{text}\n" for text in self._iter_multimsg_texts(inner_json))
+            self._card_cache.set(card_data, json_records)
+        return json_records
+
+    def _iter_multimsg_texts(self, inner_json: Dict[str, Any]) -> Iterator[str]:
+        """
+        逐条产出 com.tencent.multimsg 卡片中的预览文本，非合并转发卡片不产出任何内容。
+        """
+        # 直接下标访问，缺失任一层级即判定为非合并转发卡片，不为中间层分配空字典
+        try:
+            if inner_json["app"] != "com.tencent.multimsg" or inner_json["config"]["forward"] != 1:
+                return
+            news_items = inner_json["meta"]["detail"]["news"]
+        except (KeyError, TypeError):
+            return
+
+        for item in news_items:
+            text_content = item.get("text")
+            if text_content:
+                clean_text = text_content.strip()
+                if _IMG_TAG in clean_text:
+                    clean_text = clean_text.replace(_IMG_TAG, "").strip()
+                if clean_text:
+                    yield clean_text
+
+    def _build_prompt(self, template: str, query: str, chat_records: str) -> str:
+        """
+        用预先构建的模板生成提示词。聊天记录超过 _MAX_CHAT_RECORD_CHARS 时按行截断。
+        """
+        if len(chat_records) > _MAX_CHAT_RECORD_CHARS:
+            cut = chat_records.rfind("\n", 0, _MAX_CHAT_RECORD_CHARS) + 1
+            if cut:
+                chat_records = chat_records[:cut]
+            else:
+                # 首条记录本身就超出上限，没有可用的行边界，按字符硬截断以保留部分内容
+                chat_records = chat_records[:_MAX_CHAT_RECORD_CHARS] + "\n"
+            chat_records += "（聊天记录过长，后续内容已省略）\n"
+        return template % (query, chat_records)
 
     @filter.on_llm_request()
     async def modify_llm_request(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -117,174 +564,100 @@ class ForwardReader(Star):
         [唤醒模式]：当 LLM 请求被框架唤醒时触发。插件将聊天记录注入到现有请求末尾。
         此模式处理所有 is_at_or_wake_command = True 的情况。
         """
-        if not IS_AIOCQHTTP or not isinstance(event, AiocqhttpMessageEvent) or not event.is_at_or_wake_command:
+        if _AIOCQ_TYPE is None or not isinstance(event, _AIOCQ_TYPE) or not event.is_at_or_wake_command:
             return
         
         forward_id: Optional[str] = None 
         reply_seg: Optional[Comp.Reply] = None 
-        json_extracted_texts = [] 
         
         # --- 提取转发 ID / 内容 ---
+        # 只关心第一个转发与第一个回复，两者都找到后立即结束扫描；
+        # 不含转发或回复的普通消息扫描一遍后即在下方直接返回
+        seg_kind = self._SEG_DISPATCH.get
         for seg in event.message_obj.message: 
-            if isinstance(seg, Comp.Forward): 
+            kind = seg_kind(type(seg))
+            if kind == "forward" and not forward_id: 
                 forward_id = seg.id 
-                break
-            elif isinstance(seg, Comp.Reply): 
+                if reply_seg:
+                    break
+            elif kind == "reply" and reply_seg is None: 
                 reply_seg = seg 
-        
-        if not forward_id and reply_seg:
-            try: 
-                client = event.bot 
-                original_msg = await client.api.call_action('get_msg', message_id=reply_seg.id)
-                
-                if original_msg and 'message' in original_msg: 
-                    original_message_chain = original_msg['message'] 
-                    
-                    if isinstance(original_message_chain, list): 
-                        for segment in original_message_chain: 
-                            seg_type = segment.get("type")
-
-                            if seg_type == "forward": 
-                                forward_id = segment.get("data", {}).get("id") 
-                                if forward_id: break
-                            
-                            elif seg_type == "json":
-                                try:
-                                    inner_data_str = segment.get("data", {}).get("data")
-                                    if inner_data_str:
-                                        inner_data_str = inner_data_str.replace("&#44;", ",")
-                                        inner_json = json.loads(inner_data_str)
-                                        if inner_json.get("app") == "com.tencent.multimsg" and inner_json.get("config", {}).get("forward") == 1:
-                                            news_items = inner_json.get("meta", {}).get("detail", {}).get("news", [])
-                                            for item in news_items:
-                                                text_content = item.get("text")
-                                                if text_content:
-                                                    clean_text = text_content.strip().replace("[图片]", "").strip()
-                                                    if clean_text: json_extracted_texts.append(clean_text)
-                                            if json_extracted_texts: break
-                                except (json.JSONDecodeError, TypeError, KeyError) as e:
-                                    logger.debug(f"解析 JSON 消息内容失败: {e}")
-                                    continue
-                        
-            except Exception as e: 
-                logger.warning(f"获取被回复消息详情失败: {e}") 
-        
-        if forward_id or json_extracted_texts:
-            image_urls = []
-            try:
                 if forward_id:
-                    extracted_texts, image_urls = await self._extract_forward_content(event, forward_id)
-                else:
-                    extracted_texts = json_extracted_texts
-            except ValueError as e:
-                logger.warning(f"唤醒模式下内容提取失败，跳过注入: {e}")
-                return 
-            
-            if not extracted_texts and not image_urls:
-                return
+                    break
+        
+        if not forward_id and not reply_seg:
+            return
 
-            chat_records = "\n".join(extracted_texts)
-            
-            # 1. 确定用户问题：如果 req.prompt 为空（用户只 @Bot），则使用默认问题
-            user_question = req.prompt.strip()
-            if not user_question:
-                 user_question = "请总结一下这个聊天记录"
-            
-            # 2. 构建上下文
-            context_prompt = (
-                f"\n\n用户是在吐槽以下聊天记录中的内容，请根据以下聊天记录内容来响应用户的吐槽。聊天记录如下：\n"
-                f"--- 聊天记录开始 ---\n"
-                f"{chat_records}\n"
-                f"--- 聊天记录结束 ---"
-            )
-            
-            # 3. 修改 ProviderRequest：注入到末尾
-            req.prompt = user_question + context_prompt
-            req.image_urls.extend(image_urls)
-            
-            logger.info(f"成功注入转发内容 ({len(extracted_texts)} 条文本, {len(image_urls)} 张图片) 到 LLM 请求末尾。")
+        _, chat_records, record_count, image_urls = await self._collect_content(event, forward_id, reply_seg)
+        if not chat_records and not image_urls:
+            return
+
+        # 1. 确定用户问题：如果 req.prompt 为空（用户只 @Bot），则使用默认问题
+        user_question = req.prompt.strip()
+        if not user_question:
+            user_question = _DEFAULT_QUERY
+        
+        # 2. 构建上下文，并修改 ProviderRequest：注入到末尾
+        req.prompt = self._build_prompt(_WAKE_PROMPT_TEMPLATE, user_question, chat_records)
+        # image_urls 在解析时已去重，这里只需跳过请求中已有的图片（如用户消息自带的同一张图）
+        existing_urls = set(req.image_urls)
+        req.image_urls.extend(url for url in image_urls if url not in existing_urls)
+        
+        logger.info(f"成功注入转发内容 ({record_count} 条文本, {len(image_urls)} 张图片) 到 LLM 请求末尾。")
 
     @filter.event_message_type(filter.EventMessageType.ALL) 
     async def on_any_message(self, event: AstrMessageEvent, *args, **kwargs): 
         """ 
         [自动模式] 监听所有消息，仅当配置开启且 LLM 未被唤醒时，手动触发 LLM 请求。
         """ 
-        if not IS_AIOCQHTTP or not isinstance(event, AiocqhttpMessageEvent): 
+        if _AIOCQ_TYPE is None or not isinstance(event, _AIOCQ_TYPE): 
             return 
 
-        is_bot_awaken = event.is_at_or_wake_command
-        
         # 退出条件 1: 如果是唤醒消息，则交给 modify_llm_request 钩子处理
-        if is_bot_awaken:
+        if event.is_at_or_wake_command:
             return 
         
+        # 配置在消息处理期间不会变化，绑定为局部变量
+        enable_direct = self.enable_direct_analysis
+        enable_reply = self.enable_reply_analysis
+
         # 退出条件 2: 如果两个配置都关闭，则退出
-        if not self.enable_direct_analysis and not self.enable_reply_analysis:
+        if not enable_direct and not enable_reply:
             return
 
         # --- 提取转发 ID / 内容 ---
         forward_id: Optional[str] = None 
         reply_seg: Optional[Comp.Reply] = None 
-        user_query: str = event.message_str.strip() 
-        json_extracted_texts = []
 
+        # 单次扫描消息链：所需的转发 / 回复都已确定时立即结束
+        seg_kind = self._SEG_DISPATCH.get
         for seg in event.message_obj.message: 
-            if isinstance(seg, Comp.Forward): 
-                if self.enable_direct_analysis: # 仅检查自动配置
+            kind = seg_kind(type(seg))
+            if kind == "forward": 
+                if enable_direct and seg.id: # 仅检查自动配置
                     forward_id = seg.id 
-                    if not user_query:
-                        user_query = "请总结一下这个聊天记录" 
-                    if forward_id: 
+                    # 被回复消息仅作为直接转发提取失败时的回退
+                    if reply_seg or not enable_reply:
                         break
-            elif isinstance(seg, Comp.Reply): 
+            elif kind == "reply" and enable_reply and reply_seg is None: 
                 reply_seg = seg 
+                if forward_id or not enable_direct:
+                    break
         
-        if self.enable_reply_analysis and not forward_id and reply_seg:
-            try: 
-                client = event.bot 
-                original_msg = await client.api.call_action('get_msg', message_id=reply_seg.id)
-                if original_msg and 'message' in original_msg: 
-                    original_message_chain = original_msg['message'] 
-                    if isinstance(original_message_chain, list): 
-                        for segment in original_message_chain: 
-                            seg_type = segment.get("type")
-                            if seg_type == "forward": 
-                                forward_id = segment.get("data", {}).get("id") 
-                                if forward_id:
-                                    if not user_query: user_query = "请总结一下这个聊天记录" 
-                                    break
-                            elif seg_type == "json":
-                                try:
-                                    inner_data_str = segment.get("data", {}).get("data")
-                                    if inner_data_str:
-                                        inner_data_str = inner_data_str.replace("&#44;", ",")
-                                        inner_json = json.loads(inner_data_str)
-                                        if inner_json.get("app") == "com.tencent.multimsg" and inner_json.get("config", {}).get("forward") == 1:
-                                            news_items = inner_json.get("meta", {}).get("detail", {}).get("news", [])
-                                            for item in news_items:
-                                                text_content = item.get("text")
-                                                if text_content:
-                                                    clean_text = text_content.strip().replace("[图片]", "").strip()
-                                                    if clean_text: json_extracted_texts.append(clean_text)
-                                            if json_extracted_texts:
-                                                if not user_query: user_query = "请总结一下这个聊天记录"
-                                                break
-                                except (json.JSONDecodeError, TypeError, KeyError):
-                                    continue
-            except Exception as e: 
-                logger.warning(f"获取被回复消息详情失败: {e}") 
-        
-        # 只有在找到内容且有提问时才继续
-        if (forward_id or json_extracted_texts) and user_query:
+        # 退出条件 3: 消息中没有可分析的转发或回复（绝大多数普通消息）
+        if not forward_id and not reply_seg:
+            return
+
+        user_query: str = event.message_str.strip() 
+
+        found_content, chat_records, _, image_urls = await self._collect_content(event, forward_id, reply_seg)
+
+        # 只有在找到内容时才继续
+        if found_content:
+            if not user_query:
+                user_query = _DEFAULT_QUERY
             try: 
-                # 提取合并转发内容
-                image_urls = []
-                if forward_id:
-                    extracted_texts, image_urls = await self._extract_forward_content(event, forward_id) 
-                else:
-                    extracted_texts = json_extracted_texts
-                
-                if not extracted_texts and not image_urls: 
+                if not chat_records and not image_urls: 
                     yield event.plain_result("无法从合并转发消息中提取到任何有效内容。") 
                     return 
                 
@@ -292,20 +665,13 @@ class ForwardReader(Star):
                 await event.send(event.chain_result([Comp.Reply(id=event.message_obj.message_id), Comp.Plain("正在分析聊天记录，请稍候...")])) 
 
                 # 构建用于LLM分析的最终提示词
-                chat_records = "\n".join(extracted_texts) 
-                final_prompt = ( 
-                    f"这是用户的问题：'{user_query}'\n\n"
-                    f"请根据以下聊天记录内容来回答用户的问题。聊天记录如下：\n"
-                    f"--- 聊天记录开始 ---\n"
-                    f"{chat_records}\n"
-                    f"--- 聊天记录结束 ---"
-                ) 
+                final_prompt = self._build_prompt(_AUTO_PROMPT_TEMPLATE, user_query, chat_records)
 
                 logger.info(f"ForwardReader [自动模式]: 准备向LLM发送请求，Prompt长度: {len(final_prompt)}, 图片数量: {len(image_urls)}") 
 
                 yield event.request_llm( 
                     prompt=final_prompt, 
-                    image_urls=image_urls 
+                    image_urls=list(image_urls) 
                 ) 
                 event.stop_event() 
 